@@ -4,6 +4,7 @@ import sys
 sys.path.insert(0, "D:/work/Personal/ml_project_2_deep_hedging/src")
 
 import json
+from functools import partial
 import numpy as np
 import pandas as pd
 
@@ -21,6 +22,7 @@ if __name__ == "__main__":
 
     BATCH_SIZE = 1024
     N_EPISODE = 20000
+    N_ENVS = 1  # environments stepped in lockstep, all episodes have the same length
     epsilon = 0.5
 
     with open("model/hypparams.json", "r") as file:
@@ -31,11 +33,15 @@ if __name__ == "__main__":
     # critic_lr = 10 ** hyp_params["critic_lr"]
     # update_req = hyp_params["update_freq"]
 
-    env = StockTradingEnv(reset_path=True, tc=0.0001)
+    envs = [StockTradingEnv(reset_path=True, tc=0.0001) for _ in range(N_ENVS)]
+    # the first env's price stats normalize the replayed states, its episode is logged
+    env = envs[0]
 
     try:
         with open(result_folder_path + "/price_stat.json", "r") as f:
-            env.price_stat = json.load(f)
+            price_stat = json.load(f)
+        for e in envs:
+            e.price_stat = price_stat
     except:
         print("no price stats.")
 
@@ -43,9 +49,9 @@ if __name__ == "__main__":
     nState, nAction = env.observation_space.shape[0], env.action_space.shape[0]  # 3, 1
 
     # we use hidden layer size of 32, 64 as the author used.
-    actor = MLP(nState, 16, nAction, "Sigmoid")
-    qnet_1 = MLP(nState + nAction, 16, nAction, "")
-    qnet_2 = MLP(nState + nAction, 16, nAction, "")
+    actor = partial(MLP, nState, 16, nAction, "Sigmoid")
+    qnet_1 = partial(MLP, nState + nAction, 16, nAction, "")
+    qnet_2 = partial(MLP, nState + nAction, 16, nAction, "")
 
     # load agent settings
     agent = DDPG_Hedger(actor, qnet_1, qnet_2, actor_lr, critic_lr, 1, BATCH_SIZE)
@@ -55,28 +61,35 @@ if __name__ == "__main__":
     min_actor_loss = 0
     for episode in range(N_EPISODE):
         # reset state
-        state = env.reset()  # s_0
+        states = [e.reset() for e in envs]  # s_0
         actions = []
         ep_tot_reward = 0
 
         while True:
             # normalize the state
-            normalized_state = env.normalize(state)
+            normalized_states = [e.normalize(st) for e, st in zip(envs, states)]
 
-            # take action given state
-            action = agent.act(normalized_state, epsilon)
+            # take action given state, act_batch runs one forward for all environments
+            if N_ENVS == 1:
+                step_actions = [agent.act(normalized_states[0], epsilon)]
+            else:
+                step_actions = agent.act_batch(normalized_states, epsilon)
 
             # take next step of the environment
-            next_state, reward, done = env.step(action)
+            next_states, rewards, dones = zip(
+                *[e.step(a) for e, a in zip(envs, step_actions)]
+            )
 
             # record interaction between environment and the agent
-            agent.store(state, action, -reward, next_state, done)
+            agent.store_batch(
+                states, step_actions, -np.asarray(rewards), next_states, dones
+            )
 
-            ep_tot_reward += reward
-            state = next_state
+            ep_tot_reward += rewards[0]
+            states = next_states
 
-            actions.append(np.round(action, 2))
-            if done:
+            actions.append(np.round(step_actions[0], 2))
+            if dones[0]:
                 break
 
         for i in range(1):
@@ -124,6 +137,9 @@ if __name__ == "__main__":
     # save trained weight for the later use.
     # agent.save(experiment_name)
 
+    # stop the agent's background worker (if any)
+    agent.close()
+
     # save running stats of price variable
     with open(result_folder_path + "/price_stat.json", "w") as f:
         json.dump(env.price_stat, f)
@@ -1,25 +1,41 @@
+import os
+import threading
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
-from copy import deepcopy
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
 from buffer import ExpReplay
-from collections import namedtuple
-from torch.distributions import Normal
 from paths import MODEL_ROOT
 
 
+def _scale_action(mu: torch.Tensor) -> torch.Tensor:
+    # actor outputs a fraction of the notional, holdings are clipped to [0, 100]
+    return torch.clamp(mu * 100, 0, 100)
+
+
+def _explore(mu: torch.Tensor, draws: torch.Tensor, epsilon: float) -> torch.Tensor:
+    # epsilon-greedy: draws[0] picks the explored actions, draws[1] holds their values
+    return _scale_action(torch.where(draws[0] <= epsilon, draws[1], mu))
+
+
 class DDPG_Hedger:
     def __init__(
         self,
-        Actor: nn.Module,
-        Critic_1: nn.Module,
-        Critic_2: nn.Module,
+        actor_builder: Callable[[], nn.Module],
+        critic_1_builder: Callable[[], nn.Module],
+        critic_2_builder: Callable[[], nn.Module],
         actor_lr: float,
         critic_lr: float,
         disc_rate: float = 1,
         batch_size: int = 32,
+        use_torch_compile: bool = False,
+        device="cpu",
+        use_autocast: bool = False,
+        async_update: bool = False,
+        seed: Optional[int] = None,
     ):
 
         # params
@@ -27,17 +43,66 @@ class DDPG_Hedger:
         self.tau = 0.0001
         self.batch_size = batch_size
 
-        # experience replay related
-        self.transition = namedtuple(
-            "Transition",
-            ("state", "action", "reward", "next_state", "done"),
+        # agent-local generator for exploration and replay sampling, seedable for
+        # reproducible runs
+        self._rng = np.random.default_rng(seed)
+
+        # cpu by default, pass device="cuda" to opt in (the per-step .item() in act
+        # syncs the gpu, so tiny networks rarely gain from it)
+        self.device = torch.device(device)
+
+        # bf16 autocast needs no loss scaling, it only affects float32 networks
+        self.use_autocast = use_autocast
+
+        # define actor and critic ANN with their target networks (and the async acting
+        # snapshot), a seed fixes their init and leaves the caller's torch rng alone
+        with torch.random.fork_rng(devices=[], enabled=seed is not None):
+            if seed is not None:
+                torch.default_generator.manual_seed(seed)
+            self.actor = actor_builder().to(self.device)
+            self.critic_1 = critic_1_builder().to(self.device)  # mean(cost)
+            self.critic_2 = critic_2_builder().to(self.device)  # std(cost)
+
+            # define target network needed for DDPG optimization
+            self.actor_target = self._build_target(actor_builder, self.actor)
+            self.critic_1_target = self._build_target(critic_1_builder, self.critic_1)
+            self.critic_2_target = self._build_target(critic_2_builder, self.critic_2)
+
+            self._actor_snapshot = None
+            if async_update:
+                self._actor_snapshot = self._build_target(actor_builder, self.actor)
+
+        # reusable input buffer for act, sized from the actor's first/last linear layers
+        linears = [m for m in self.actor.modules() if isinstance(m, nn.Linear)]
+        self.state_dim = linears[0].in_features
+        self.action_dim = linears[-1].out_features
+        self._state_buf = torch.empty(
+            self.state_dim,
+            dtype=linears[0].weight.dtype,
+            pin_memory=self.device.type == "cuda",
+        )
+        self._state_np = self._state_buf.numpy()  # shares memory with _state_buf
+        self._state_dev = self._state_buf.to(self.device)  # aliases _state_buf on cpu
+
+        # experience replay related, sharing _rng with act is safe with async_update
+        # because numpy's Generator serializes its draws with an internal lock
+        self.buffer = ExpReplay(
+            600000,
+            self.state_dim,
+            self.action_dim,
+            dtype=self._state_np.dtype,
+            device=self.device,
+            rng=self._rng,
         )
-        self.buffer = ExpReplay(600000, self.transition)
 
-        # define actor and critic ANN.
-        self.actor = Actor
-        self.critic_1 = Critic_1  # mean(cost)
-        self.critic_2 = Critic_2  # std(cost)
+        # reusable (batch, state + action) critic inputs for update
+        self._sa_buf = torch.empty(
+            batch_size,
+            self.state_dim + self.action_dim,
+            dtype=self._state_buf.dtype,
+            device=self.device,
+        )
+        self._next_sa_buf = torch.empty_like(self._sa_buf)
 
         # loss function for critic
         self.critic_loss = nn.MSELoss()
@@ -47,22 +112,112 @@ class DDPG_Hedger:
         self.critic_1_optimizer = optim.Adam(self.critic_1.parameters(), lr=critic_lr)
         self.critic_2_optimizer = optim.Adam(self.critic_2.parameters(), lr=critic_lr)
 
-        # define target network needed for DDPG optimization
-        self.actor_target = deepcopy(self.actor)
-        self.critic_1_target = deepcopy(self.critic_1)
-        self.critic_2_target = deepcopy(self.critic_2)
-
         # temporary
         self.actor_target.isPrint = False
         self.critic_1_target.isPrint = False
         self.critic_2_target.isPrint = False
 
+        # cache parameter tuples once, polyak_update blends them in place
+        self._actor_params = tuple(self.actor.parameters())
+        self._critic_1_params = tuple(self.critic_1.parameters())
+        self._critic_2_params = tuple(self.critic_2.parameters())
+        self._actor_target_params = tuple(self.actor_target.parameters())
+        self._critic_1_target_params = tuple(self.critic_1_target.parameters())
+        self._critic_2_target_params = tuple(self.critic_2_target.parameters())
+
+        # with async_update the actor trains on the worker thread, so acting uses a
+        # snapshot of it that is refreshed after every update
+        if self._actor_snapshot is not None:
+            self._actor_snapshot_params = tuple(self._actor_snapshot.parameters())
+        self._act_lock = threading.Lock()
+
+        # keep the eager modules around, save/load work on their plain state_dict keys
+        self._actor_orig = self.actor
+        self._critic_1_orig = self.critic_1
+        self._critic_2_orig = self.critic_2
+
+        # optionally compile every network (tiny MLPs are dominated by launch overhead)
+        self.use_torch_compile = use_torch_compile
+        self.actor = self._compile(self.actor)
+        self.critic_1 = self._compile(self.critic_1)
+        self.critic_2 = self._compile(self.critic_2)
+        self.actor_target = self._compile(self.actor_target)
+        self.critic_1_target = self._compile(self.critic_1_target)
+        self.critic_2_target = self._compile(self.critic_2_target)
+        self._acting_actor = self.actor
+        if self._actor_snapshot is not None:
+            self._acting_actor = self._compile(self._actor_snapshot)
+
+        # action post-processing, fused into a single kernel when compiling
+        self._scale_action = _scale_action
+        self._explore = _explore
+        if self.use_torch_compile:
+            self._scale_action = torch.compile(
+                _scale_action, fullgraph=True, dynamic=True
+            )
+            self._explore = torch.compile(_explore, fullgraph=True, dynamic=True)
+
+        # optional single background worker running update/polyak_update in order,
+        # so the gradient step overlaps with stepping the environment (sampling then
+        # depends on thread timing, keep it off for reproducible runs)
+        self.async_update = async_update
+        self._pool = ThreadPoolExecutor(max_workers=1) if async_update else None
+        self._pending = None  # future of the last submitted update
+        self._polyak_pending = None  # future of the last submitted polyak_update
+
+    def _build_target(self, builder: Callable[[], nn.Module], network: nn.Module):
+        # fresh instance with copied weights, frozen so autograd never tracks it
+        target = builder().to(self.device)
+        target.load_state_dict(network.state_dict())
+        for param in target.parameters():
+            param.requires_grad_(False)
+        return target
+
+    def _compile(self, network: nn.Module):
+        if not self.use_torch_compile:
+            return network
+        return torch.compile(network, mode="reduce-overhead", fullgraph=True)
+
+    def _autocast(self):
+        return torch.autocast(
+            self.device.type, dtype=torch.bfloat16, enabled=self.use_autocast
+        )
+
+    def _check_polyak(self):
+        # re-raise a failure of the last background polyak_update
+        if self._polyak_pending is not None:
+            self._polyak_pending.result()
+
+    def synchronize(self):
+        # wait for the background update/polyak_update work submitted so far
+        if self._pending is not None:
+            self._pending.result()
+        self._check_polyak()
+
+    def close(self):
+        # finish the background work and stop the worker thread
+        self.synchronize()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _refresh_actor_snapshot(self):
+        if self._actor_snapshot is None:
+            return
+        with self._act_lock, torch.no_grad():
+            torch._foreach_copy_(self._actor_snapshot_params, self._actor_params)
+
     def reset(self):
+        self.synchronize()
         self.buffer.clear()
 
     def store(self, *args):
         self.buffer.store(*args)
 
+    def store_batch(self, *args):
+        self.buffer.store_batch(*args)
+
+    @torch.no_grad()
     def act(self, state: list, epsilon: float = 0.05, isPrint=False):
         """
         We use policy function to find the deterministic action instead of distributions
@@ -73,14 +228,55 @@ class DDPG_Hedger:
         :param state:
         :return:
         """
-        x = torch.tensor(state).to(torch.float64)
-        if np.random.rand() <= epsilon:
-            action = np.random.uniform(0, 1)
+        if self._rng.random() <= epsilon:
+            action = self._rng.uniform(0, 1)
         else:
-            action = self.actor(x).detach().item()
+            self._state_np[:] = state
+            if self.device.type == "cuda":
+                self._state_dev.copy_(self._state_buf, non_blocking=True)
+            with self._act_lock:
+                action = self._acting_actor(self._state_dev).item()
         return np.clip(action * 100, 0, 100.0)
 
+    @torch.no_grad()
+    def act_batch(self, states, epsilon: float = 0.05):
+        """
+        Same as act, but for a (n_envs, state_dim) batch of states stepped in lockstep,
+        so the actor runs a single forward pass per tick.
+        :param states:
+        :return: (n_envs,) array of actions
+        """
+        # no copy when states already is an array of the networks' dtype
+        x = torch.from_numpy(np.asarray(states, dtype=self._state_np.dtype))
+        draws = self._rng.random((2, len(x), self.action_dim))
+        if (draws[0] <= epsilon).all():
+            # every environment explores, the actor forward is not needed
+            return np.clip(draws[1] * 100, 0, 100.0).squeeze(-1)
+
+        x = x.to(self.device, non_blocking=True)
+        with self._act_lock:
+            mu = self._acting_actor(x)
+        draws = torch.from_numpy(draws)
+        draws = draws.to(device=mu.device, dtype=mu.dtype, non_blocking=True)
+        return self._explore(mu, draws, epsilon).squeeze(-1).cpu().numpy()
+
     def update(self, price_stat, output=False):
+        """
+        With async_update the gradient step is queued on the background worker and the
+        losses of the previous update are returned instead (None before there is one).
+        """
+        if not self.async_update:
+            return self._update_sync(price_stat, output)
+
+        self._check_polyak()
+        previous = self._pending
+        self._pending = self._pool.submit(self._update_sync, price_stat, output)
+        if previous is not None:
+            return previous.result()
+        if output:
+            return None, None, None
+
+    def _update_sync(self, price_stat, output=False):
         # calculate return of all times in the episode
         if self.buffer.len() < self.batch_size:
             if output:
@@ -88,37 +284,41 @@ class DDPG_Hedger:
             else:
                 return
 
-        transitions = self.buffer.sample(self.batch_size)
-        batch = self.transition(*zip(*transitions))
+        states, actions, rewards, next_states, dones = self.buffer.sample(
+            self.batch_size
+        )
+        not_dones = (~dones).to(rewards.dtype)
 
         # get rolling stats for price
-        mu_, std_ = torch.Tensor([0, price_stat[0], 0]), torch.Tensor(
-            [100, price_stat[1], 60]
+        mu_ = torch.tensor(
+            [0, price_stat[0], 0], dtype=states.dtype, device=self.device
+        )
+        std_ = torch.tensor(
+            [100, price_stat[1], 60], dtype=states.dtype, device=self.device
         )
-
-        # extract variables from sampled batch.
-        states = torch.tensor(batch.state)
-        actions = torch.tensor(batch.action)
-        rewards = torch.tensor(batch.reward)
-        dones = torch.tensor(batch.done).float()
-        next_states = torch.tensor(batch.next_state)
 
         # normalize the price in state vector
-        states = (states - mu_) / std_
-        next_states = (next_states - mu_) / std_
-
-        # define stateactions
-        stateaction = torch.hstack([states, actions])
-        next_stateaction = torch.hstack(
-            [next_states, torch.clip(self.actor_target(next_states) * 100, 0, 100)]
-        ).detach()
+        states = states.sub_(mu_).div_(std_)
+        next_states = next_states.sub_(mu_).div_(std_)
+
+        # define stateactions, written into the preallocated critic inputs
+        stateaction = torch.cat((states, actions), dim=1, out=self._sa_buf)
+
+        # target Q values, critic_1_target is shared by both targets so evaluate it once
+        with torch.no_grad(), self._autocast():
+            next_stateaction = torch.cat(
+                (next_states, self._scale_action(self.actor_target(next_states))),
+                dim=1,
+                out=self._next_sa_buf,
+            )
+            next_Q_1 = self.critic_1_target(next_stateaction)
+            next_Q_2 = self.critic_2_target(next_stateaction)
 
         # compute Q_1 loss
-        Q_1 = self.critic_1(stateaction)
-        y_1 = rewards + self.gamma * (1 - dones) * self.critic_1_target(
-            next_stateaction
-        )
-        critic_loss_1 = self.critic_loss(Q_1, y_1)
+        with self._autocast():
+            Q_1 = self.critic_1(stateaction)
+            y_1 = rewards + self.gamma * not_dones * next_Q_1
+            critic_loss_1 = self.critic_loss(Q_1, y_1)
 
         # Optimize the critic Q_1
         self.critic_1_optimizer.zero_grad()
@@ -126,14 +326,15 @@ class DDPG_Hedger:
         self.critic_1_optimizer.step()
 
         # compute Q_2 loss
-        Q_2 = self.critic_2(stateaction)
-        y_2 = (
-            rewards**2
-            + (self.gamma**2) * (1 - dones) * self.critic_2_target(next_stateaction)
-            + 2 * rewards * self.gamma * self.critic_1_target(next_stateaction)
-        )
+        with self._autocast():
+            Q_2 = self.critic_2(stateaction)
+            y_2 = (
+                rewards**2
+                + (self.gamma**2) * not_dones * next_Q_2
+                + 2 * rewards * self.gamma * next_Q_1
+            )
 
-        critic_loss_2 = self.critic_loss(Q_2, y_2)
+            critic_loss_2 = self.critic_loss(Q_2, y_2)
 
         # Optimize the critic Q_2
         self.critic_2_optimizer.zero_grad()
@@ -141,60 +342,90 @@ class DDPG_Hedger:
         self.critic_2_optimizer.step()
 
         # Get actor loss
-        state_action = torch.hstack(
-            [states, torch.clip(self.actor(states) * 100, 0, 100)]
-        )
+        with self._autocast():
+            state_action = torch.hstack(
+                [states, self._scale_action(self.actor(states))]
+            )
 
-        q_1, q_2 = self.critic_1(state_action), self.critic_2(state_action)
-        cost_std = torch.sqrt(torch.where(q_2 - q_1.pow(2) < 0, 0, q_2 - q_1.pow(2)))
-        actor_loss = (q_1 + 1.5 * cost_std).mean()
+            q_1, q_2 = self.critic_1(state_action), self.critic_2(state_action)
+            cost_std = torch.sqrt(
+                torch.where(q_2 - q_1.pow(2) < 0, 0, q_2 - q_1.pow(2))
+            )
+            actor_loss = (q_1 + 1.5 * cost_std).mean()
 
         # Optimize the actor
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
         self.actor_optimizer.step()
+        self._refresh_actor_snapshot()
 
         if output:
             return critic_loss_1, critic_loss_2, actor_loss.detach().item()
 
     def polyak_update(self):
-        # Update the frozen target models
-        for trg_param, src_param in zip(
-            list(self.critic_1_target.parameters()), list(self.critic_1.parameters())
-        ):
-            trg_param = trg_param * (1.0 - self.tau) + src_param * self.tau
-
-        # Update the frozen target models
-        for trg_param, src_param in zip(
-            list(self.critic_2_target.parameters()), list(self.critic_2.parameters())
-        ):
-            trg_param = trg_param * (1.0 - self.tau) + src_param * self.tau
-
-        for trg_param, src_param in zip(
-            list(self.actor_target.parameters()), list(self.actor.parameters())
-        ):
-            trg_param = trg_param * (1.0 - self.tau) + src_param * self.tau
+        if self.async_update:
+            self._check_polyak()
+            self._polyak_pending = self._pool.submit(self._polyak_update)
+        else:
+            self._polyak_update()
 
-    def save(self, name):
-        torch.save(
-            self.critic_1.state_dict(), MODEL_ROOT + f"/{name}/critic_1_weight.pt"
+    @torch.no_grad()
+    def _polyak_update(self):
+        # Update the frozen target models: trg = trg + tau * (src - trg)
+        torch._foreach_lerp_(
+            self._critic_1_target_params, self._critic_1_params, self.tau
+        )
+        torch._foreach_lerp_(
+            self._critic_2_target_params, self._critic_2_params, self.tau
         )
+        torch._foreach_lerp_(self._actor_target_params, self._actor_params, self.tau)
+
+    def save(self, name):
+        self.synchronize()
+
+        # weights and optimizer states of Q_1, Q_2, Actor in a single file
         torch.save(
-            self.critic_2.state_dict(), MODEL_ROOT + f"/{name}/critic_2_weight.pt"
+            {
+                "critic_1": self._critic_1_orig.state_dict(),
+                "critic_2": self._critic_2_orig.state_dict(),
+                "actor": self._actor_orig.state_dict(),
+                "critic_1_optimizer": self.critic_1_optimizer.state_dict(),
+                "critic_2_optimizer": self.critic_2_optimizer.state_dict(),
+                "actor_optimizer": self.actor_optimizer.state_dict(),
+            },
+            MODEL_ROOT + f"/{name}/checkpoint.pt",
         )
-        torch.save(self.actor.state_dict(), MODEL_ROOT + f"/{name}/actor_weight.pt")
 
     def load(self, name):
+        self.synchronize()
+
+        checkpoint_path = MODEL_ROOT + f"/{name}/checkpoint.pt"
+        if os.path.exists(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, map_location=self.device)
+        else:
+            # older models (v1 - v9) store one weight file per network
+            checkpoint = {
+                network: torch.load(
+                    MODEL_ROOT + f"/{name}/{network}_weight.pt",
+                    map_location=self.device,
+                )
+                for network in ("critic_1", "critic_2", "actor")
+            }
+
         # load trained weights to Q_1, Q_2, Actor
-        self.critic_1.load_state_dict(
-            torch.load(MODEL_ROOT + f"/{name}/critic_1_weight.pt")
-        )
-        self.critic_2.load_state_dict(
-            torch.load(MODEL_ROOT + f"/{name}/critic_2_weight.pt")
-        )
-        self.actor.load_state_dict(torch.load(MODEL_ROOT + f"/{name}/actor_weight.pt"))
+        self._critic_1_orig.load_state_dict(checkpoint["critic_1"])
+        self._critic_2_orig.load_state_dict(checkpoint["critic_2"])
+        self._actor_orig.load_state_dict(checkpoint["actor"])
+
+        # resume the optimizers as well when the checkpoint has them
+        if "actor_optimizer" in checkpoint:
+            self.critic_1_optimizer.load_state_dict(checkpoint["critic_1_optimizer"])
+            self.critic_2_optimizer.load_state_dict(checkpoint["critic_2_optimizer"])
+            self.actor_optimizer.load_state_dict(checkpoint["actor_optimizer"])
 
         # Copy above 3 to target networks.
-        self.critic_1_target = deepcopy(self.critic_1)
-        self.critic_2_target = deepcopy(self.critic_2)
-        self.actor_target = deepcopy(self.actor)
+        with torch.no_grad():
+            torch._foreach_copy_(self._critic_1_target_params, self._critic_1_params)
+            torch._foreach_copy_(self._critic_2_target_params, self._critic_2_params)
+            torch._foreach_copy_(self._actor_target_params, self._actor_params)
+        self._refresh_actor_snapshot()
@@ -1,28 +1,108 @@
-import random
+import threading
 import numpy as np
-from collections import deque
+import torch
+
 
 class ExpReplay:
-    def __init__(self, capacity, transition):
-        self.memory = deque([], maxlen=capacity)
-        self.record = transition
+    def __init__(
+        self, capacity, state_dim, action_dim, dtype=np.float64, device="cpu", rng=None
+    ):
+        self.capacity = capacity
+        self.device = torch.device(device)
+        self.rng = np.random.default_rng() if rng is None else rng
+
+        # one preallocated ring buffer per field of a transition
+        self.states = np.empty((capacity, state_dim), dtype=dtype)
+        self.actions = np.empty((capacity, action_dim), dtype=dtype)
+        self.rewards = np.empty((capacity, 1), dtype=dtype)
+        self.next_states = np.empty((capacity, state_dim), dtype=dtype)
+        self.dones = np.empty((capacity, 1), dtype=np.bool_)
+
+        self.pos = 0
+        self.full = False
+
+        # store may run on the main thread while an update samples on a worker
+        self._lock = threading.Lock()
+
+        # per-field scratch buffers the sampled rows are gathered into (pinned on cuda)
+        self._scratch = None
+        self._copy_done = None
 
     def len(self):
-        return len(self.memory)
+        return self.capacity if self.full else self.pos
 
-    def store(self, *args):
+    def store(self, state, action, reward, next_state, done):
         """Save a transition"""
-        record = self.record(*[item.tolist() if type(item) == np.ndarray else item if type(item) == list else [item] for item in list(args)])
-        self.memory.append(record)
+        with self._lock:
+            self.states[self.pos] = state
+            self.actions[self.pos] = action
+            self.rewards[self.pos] = reward
+            self.next_states[self.pos] = next_state
+            self.dones[self.pos] = done
+
+            self.pos = (self.pos + 1) % self.capacity
+            self.full = self.full or self.pos == 0
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        """Save a batch of transitions, one row per environment"""
+        n = len(rewards)
+        with self._lock:
+            idx = (self.pos + np.arange(n)) % self.capacity
+            self.states[idx] = states
+            self.actions[idx] = np.reshape(actions, (n, -1))
+            self.rewards[idx, 0] = rewards
+            self.next_states[idx] = next_states
+            self.dones[idx, 0] = dones
+
+            self.full = self.full or self.pos + n >= self.capacity
+            self.pos = (self.pos + n) % self.capacity
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        """
+        Sample (states, actions, rewards, next_states, dones) tensors of batch_size rows.
+        On cpu the returned tensors share memory with scratch buffers that the next
+        sample call overwrites.
+        """
+        fields = (self.states, self.actions, self.rewards, self.next_states, self.dones)
+        if self._scratch is None or len(self._scratch[0]) != batch_size:
+            self._scratch = [self._make_scratch(arr, batch_size) for arr in fields]
+
+        # the previous host-to-device copy must be done before the scratch is reused
+        if self._copy_done is not None:
+            self._copy_done.synchronize()
+
+        with self._lock:
+            idx = self.rng.integers(0, self.len(), batch_size)
+            for arr, scratch in zip(fields, self._scratch):
+                # mode="clip" lets np.take write into out directly, idx is in range
+                np.take(arr, idx, axis=0, out=scratch.numpy(), mode="clip")
+        batch = [scratch.to(self.device, non_blocking=True) for scratch in self._scratch]
+
+        if self.device.type == "cuda":
+            self._copy_done = torch.cuda.Event()
+            self._copy_done.record()
+        return tuple(batch)
+
+    def _make_scratch(self, arr, batch_size):
+        scratch = torch.from_numpy(np.empty((batch_size,) + arr.shape[1:], arr.dtype))
+        if self.device.type == "cuda":
+            scratch = scratch.pin_memory()
+        return scratch
 
     def _all(self):
-        return list(self.memory)
+        n = self.len()
+        return (
+            self.states[:n],
+            self.actions[:n],
+            self.rewards[:n],
+            self.next_states[:n],
+            self.dones[:n],
+        )
 
     def clear(self):
-        return self.memory.clear()
+        with self._lock:
+            self.pos = 0
+            self.full = False
 
 
 class PrioritizedExpReplay(ExpReplay):
@@ -31,8 +111,8 @@ class PrioritizedExpReplay(ExpReplay):
 
     """
 
-    def __init__(self, capacity, transition, alpha):
-        super().__init__(capacity, transition)
+    def __init__(self, capacity, state_dim, action_dim, alpha, device="cpu"):
+        super().__init__(capacity, state_dim, action_dim, device=device)
         self.alpha = alpha
         self.priority_sum = [0 for _ in range(2 * self.capacity)]
         self.priority_min = [float("inf") for _ in range(2 * self.capacity)]
@@ -44,7 +124,7 @@ class PrioritizedExpReplay(ExpReplay):
         """Save a transition"""
         idx = self.next_idx
 
-        self.memory.append(self.record(*args))
+        super().store(*args)
         self.next_idx = (idx + 1) % self.capacity
         self.size = min(self.capacity, self.size + 1)
 
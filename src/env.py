@@ -44,10 +44,11 @@ class StockTradingEnv(gym.Env):
         self.path_choice = int(random.uniform(0, self.nPaths))
         self.path_idx = 0
 
-        # initialize price memory for normalization
-        self.price_memory = []
-        self.price_stat = []
+        # initialize price memory for normalization (ring buffer of the last prices)
         self.window_len = 200
+        self.price_memory = np.empty(self.window_len)
+        self.n_prices = 0
+        self.price_stat = []
 
         # transaction cost (for rewards)
         self.kappa = tc
@@ -130,15 +131,15 @@ class StockTradingEnv(gym.Env):
         ]  # state0 of new path
 
     def normalize(self, state):
-        # store price data first
-        self.price_memory.append(state[1])
+        # store price data first, overwriting the oldest price once the window is full
+        self.price_memory[self.n_prices % self.window_len] = state[1]
+        self.n_prices += 1
 
-        if len(self.price_memory) == 1:
+        if self.n_prices == 1:
             mu_, std_ = 100, 1
         else:
-            mu_, std_ = np.mean(self.price_memory[-self.window_len :]), np.std(
-                self.price_memory[-self.window_len :]
-            )
+            window = self.price_memory[: min(self.n_prices, self.window_len)]
+            mu_, std_ = window.mean(), window.std()
 
         self.price_stat = [mu_, std_]
         norm_price = (state[1] - mu_) / std_
@@ -1,6 +1,7 @@
 import optuna
 import numpy as np
 import json
+from functools import partial
 
 from env import StockTradingEnv
 from agent import DDPG_Hedger
@@ -21,9 +22,9 @@ def objective(trial):
     env = StockTradingEnv(reset_path=True)
     nState, nAction = env.observation_space.shape[0], env.action_space.shape[0]  # 3, 1
 
-    actor = MLP(nState, 16, nAction, "Sigmoid")
-    qnet_1 = MLP(nState + nAction, 16, nAction, "")
-    qnet_2 = MLP(nState + nAction, 16, nAction, "")
+    actor = partial(MLP, nState, 16, nAction, "Sigmoid")
+    qnet_1 = partial(MLP, nState + nAction, 16, nAction, "")
+    qnet_2 = partial(MLP, nState + nAction, 16, nAction, "")
     agent = DDPG_Hedger(actor, qnet_1, qnet_2, actor_lr, critic_lr, 1, BATCH_SIZE)
 
     target_rewards = []